@@ -0,0 +1,127 @@
+import modal
+import torch
+from pathlib import Path
+from model import AudioClassifier
+from train import ESC50Dataset, make_mel_transform
+
+app = modal.App("Audio-Classification-TensorRT")
+
+# the tensorrt pin must match main.py, plans only load on the version that built them
+image = modal.Image.debian_slim().pip_install_from_requirements("requirements.txt").pip_install("tensorrt==10.3.0", "onnx").apt_install("libsndfile1").add_local_python_source("model", "train")
+
+volume = modal.Volume.from_name("ESC-50", create_if_missing=True)
+model_volume = modal.Volume.from_name("model-volume", create_if_missing=True)
+
+CHECKPOINT_PATH = "/models/best_model.pth"
+ONNX_PATH = "/models/best_model.onnx"
+ENGINE_PATH = "/models/best_model.plan"
+CALIBRATION_CACHE = "/models/calibration.cache"
+
+# ESC-50 clips are 5s at 44.1kHz -> 431 mel frames
+N_MELS = 128
+NUM_FRAMES = 431
+MAX_BATCH = 8
+
+
+def make_calibrator(trt, dataset, batch_size=8, num_batches=32):
+    # defined inside a factory so tensorrt is only imported in the remote container
+    class ESC50Calibrator(trt.IInt8EntropyCalibrator2):
+        def __init__(self):
+            super().__init__()
+            self.loader = iter(torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=True))
+            self.batches_left = num_batches
+            self.device_input = torch.empty((batch_size, 1, N_MELS, NUM_FRAMES), dtype=torch.float32, device="cuda")
+
+        def get_batch_size(self):
+            return batch_size
+
+        def get_batch(self, names):
+            if self.batches_left == 0:
+                return None
+            try:
+                spectrogram, _ = next(self.loader)
+            except StopIteration:
+                return None
+            if spectrogram.size(0) != batch_size:
+                return None
+            self.device_input.copy_(spectrogram[..., :NUM_FRAMES])
+            self.batches_left -= 1
+            return [int(self.device_input.data_ptr())]
+
+        def read_calibration_cache(self):
+            if Path(CALIBRATION_CACHE).exists():
+                return Path(CALIBRATION_CACHE).read_bytes()
+            return None
+
+        def write_calibration_cache(self, cache):
+            Path(CALIBRATION_CACHE).write_bytes(bytes(cache))
+
+    return ESC50Calibrator()
+
+
+@app.function(image=image, gpu="A10G", volumes={"/opt/ESC-50": volume, "/models": model_volume}, timeout=60*60)
+def build_engine():
+    import tensorrt as trt
+
+    # activation ranges from an older checkpoint do not apply to retrained weights
+    if Path(CALIBRATION_CACHE).exists() and Path(CALIBRATION_CACHE).stat().st_mtime < Path(CHECKPOINT_PATH).stat().st_mtime:
+        print(f"Removing stale calibration cache {CALIBRATION_CACHE}")
+        Path(CALIBRATION_CACHE).unlink()
+
+    checkpoint = torch.load(CHECKPOINT_PATH, map_location="cpu")
+    model = AudioClassifier(num_classes=len(checkpoint["classes"]))
+    model.load_state_dict(checkpoint["model_state_dict"])
+    model.eval()
+
+    dummy_input = torch.randn(1, 1, N_MELS, NUM_FRAMES)
+    traced = torch.jit.trace(model, dummy_input)
+    torch.onnx.export(
+        traced,
+        dummy_input,
+        ONNX_PATH,
+        opset_version=17,
+        input_names=["spectrogram"],
+        output_names=["logits"],
+        dynamic_axes={"spectrogram": {0: "batch"}, "logits": {0: "batch"}},
+    )
+    print(f"Exported ONNX model to {ONNX_PATH}")
+
+    logger = trt.Logger(trt.Logger.WARNING)
+    builder = trt.Builder(logger)
+    network = builder.create_network(1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+    parser = trt.OnnxParser(network, logger)
+    if not parser.parse(Path(ONNX_PATH).read_bytes()):
+        for i in range(parser.num_errors):
+            print(parser.get_error(i))
+        raise RuntimeError("Failed to parse ONNX model")
+
+    config = builder.create_builder_config()
+    config.set_flag(trt.BuilderFlag.INT8)
+    config.set_flag(trt.BuilderFlag.FP16)
+
+    profile = builder.create_optimization_profile()
+    # main.py pads every predict() input to NUM_FRAMES, only the batch dimension varies
+    profile.set_shape("spectrogram", (1, 1, N_MELS, NUM_FRAMES), (1, 1, N_MELS, NUM_FRAMES), (MAX_BATCH, 1, N_MELS, NUM_FRAMES))
+    config.add_optimization_profile(profile)
+
+    calibration_profile = builder.create_optimization_profile()
+    calibration_profile.set_shape("spectrogram", (8, 1, N_MELS, NUM_FRAMES), (8, 1, N_MELS, NUM_FRAMES), (8, 1, N_MELS, NUM_FRAMES))
+    config.set_calibration_profile(calibration_profile)
+
+    esc50_dir = Path("/opt/ESC-50")
+    calibration_dataset = ESC50Dataset(data_dir=esc50_dir, metadata_file=esc50_dir/"meta"/"esc50.csv", split="train", transform=make_mel_transform())
+    config.int8_calibrator = make_calibrator(trt, calibration_dataset)
+
+    serialized_engine = builder.build_serialized_network(network, config)
+    if serialized_engine is None:
+        raise RuntimeError("Failed to build TensorRT engine")
+
+    Path(ENGINE_PATH).write_bytes(bytes(serialized_engine))
+    model_volume.commit()
+    print(f"Saved INT8 engine to {ENGINE_PATH}")
+    return 0
+
+
+@app.local_entrypoint()
+def main():
+    print("building engine", build_engine.remote())
@@ -2,7 +2,10 @@ import torch
 from model import AudioClassifier
 
 m = AudioClassifier(num_classes=50)
-total = sum(p.numel() for p in m.parameters() if p.requires_grad)
+# single pass over the parameters, reused for both the total and the per-tensor listing
+params = [(n, p) for n, p in m.named_parameters() if p.requires_grad]
+counts = torch.tensor([p.numel() for _, p in params])
+total = int(counts.sum())
 print(f"Trainable params: {total:,}")
-for n, p in m.named_parameters():
-    print(f"{n:50s} {p.numel():>10}")
+for (n, p), c in zip(params, counts.tolist()):
+    print(f"{n:50s} {c:>10}")
@@ -48,8 +48,9 @@ export default function HomePage() {
         const dataUrl = reader.result as string;
         const base64String = dataUrl.split(",")[1];
 
+        // debug=1 asks the server for the per-layer feature maps passed to splitLayers
         const response = await axios.post(
-          `${process.env.NEXT_PUBLIC_MODAL_ENDPOINT}`,
+          `${process.env.NEXT_PUBLIC_MODAL_ENDPOINT}?debug=1`,
           JSON.stringify({
             audio_data: base64String,
           }),
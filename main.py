@@ -4,26 +4,82 @@ import torch.nn as nn
 import torch
 from model import AudioClassifier
 from pydantic import BaseModel
+from fastapi import Body, HTTPException, Response
+from typing import Annotated
+import orjson
 import base64
+import pybase64
 import numpy as np
 import soundfile as sf
 import io
-import librosa
+from concurrent.futures import ThreadPoolExecutor
 import requests
+import os
 
 app = modal.App(name="Audio-Classification-Inference")
 
-image = modal.Image.debian_slim().pip_install_from_requirements('requirements.txt').apt_install("libsndfile1").add_local_python_source("model")
+# the tensorrt pin must match build_engine.py, plans only load on the version that built them
+image = modal.Image.debian_slim().pip_install_from_requirements('requirements.txt').pip_install("tensorrt==10.3.0").apt_install("libsndfile1").add_local_python_source("model")
 
 model_volume = modal.Volume.from_name("model-volume")
 
+CHECKPOINT_PATH = "/models/best_model.pth"
+ENGINE_PATH = "/models/best_model.plan"
+CLIP_SAMPLES = 44100 * 5 # ESC-50 clip length the model was trained on
+NUM_FRAMES = 431 # mel frames of a CLIP_SAMPLES waveform with hop_length=512, fixed in the engine profile
+ENGINE_MAX_BATCH = 8 # upper bound of the engine's batch profile, see build_engine.py
+
 class EvaluateRequest(BaseModel):
     audio_data: str
 
+# bounded so one request cannot exhaust GPU memory; FastAPI answers oversized batches with a 422
+EvaluateBatchRequest = Annotated[list[EvaluateRequest], Body(min_length=1, max_length=ENGINE_MAX_BATCH)]
+
+def decode_audio(audio_b64):
+    # pybase64 decodes with SIMD and, with validate=False, skips the alphabet check
+    audio_bytes = pybase64.b64decode(audio_b64, validate=False)
+    with sf.SoundFile(io.BytesIO(audio_bytes)) as f:
+        sample_rate = f.samplerate
+        audio_data = f.read(dtype="float32", always_2d=False)
+
+    # libsndfile always decodes interleaved frames, so stereo is downmixed after the read
+    if audio_data.ndim > 1:
+        audio_data = np.mean(audio_data, axis=1)
+
+    # float WAV/FLAC can carry NaN/inf samples, which resampling and the STFT would spread over the whole clip
+    if not np.isfinite(audio_data).all():
+        raise HTTPException(status_code=400, detail="Audio contains NaN or infinite samples")
+    return audio_data, sample_rate
+
+class FastMelSpectrogram(T.MelSpectrogram):
+    # same output as T.MelSpectrogram, but calls torch.stft directly with the cached window
+    # and projects onto the cached mel filter bank in a single matmul
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # the direct stft call below does not implement these options, fail loudly instead of diverging
+        assert self.spectrogram.pad == 0, "FastMelSpectrogram does not support pad"
+        assert not self.spectrogram.normalized, "FastMelSpectrogram does not support normalized"
+        assert self.spectrogram.power is not None, "FastMelSpectrogram needs a power spectrogram"
+    def forward(self, waveform):
+        spec = torch.stft(
+            waveform,
+            n_fft=self.spectrogram.n_fft,
+            hop_length=self.spectrogram.hop_length,
+            win_length=self.spectrogram.win_length,
+            window=self.spectrogram.window,
+            center=self.spectrogram.center,
+            pad_mode=self.spectrogram.pad_mode,
+            onesided=self.spectrogram.onesided,
+            return_complex=True
+        )
+        power = spec.abs().pow(self.spectrogram.power) # kept in FP32, the power spectrum overflows the FP16 range
+        return torch.matmul(power.transpose(-1, -2), self.mel_scale.fb).transpose(-1, -2)
+
 class AudioProcessor:
-    def __init__(self):
+    def __init__(self, device=torch.device("cpu")):
+        self.device = device
         self.transform = nn.Sequential(
-            T.MelSpectrogram(
+            FastMelSpectrogram(
                 sample_rate=44100,
                 n_fft=2048,
                 hop_length=512,
@@ -32,12 +88,23 @@ class AudioProcessor:
                 f_max=22050
             ),
             T.AmplitudeToDB()
-        )
-    def process_audio(self,audio_data):
-        waveform= torch.from_numpy(audio_data).float()
-        waveform = waveform.unsqueeze(0)
-        spectrogram = self.transform(waveform)
-        return spectrogram.unsqueeze(0)
+        ).to(self.device)
+        self.resamplers: dict[int, T.Resample] = {}
+    def load_waveform(self,audio_data):
+        # upload the raw waveform and run resampling + STFT on the device instead of copying the spectrogram over
+        waveform = torch.from_numpy(audio_data).float()
+        if self.device.type == "cuda":
+            waveform = waveform.pin_memory()
+        return waveform.to(self.device, non_blocking=True)
+    def resample(self,waveform,sample_rate):
+        # one resampler per source rate, so the sinc kernel is only built once
+        if sample_rate not in self.resamplers:
+            self.resamplers[sample_rate] = T.Resample(sample_rate, 44100, lowpass_filter_width=16, resampling_method="sinc_interp_kaiser").to(self.device)
+        return self.resamplers[sample_rate](waveform)
+    def process_audio(self,waveform):
+        # (samples,) or (batch, samples) -> (batch, 1, n_mels, frames)
+        spectrogram = self.transform(waveform.reshape(-1, waveform.size(-1)))
+        return spectrogram.unsqueeze(1)
 
 @app.cls(image=image, gpu="A10G", volumes={"/models": model_volume}, scaledown_window=10)
 class Main:
@@ -47,7 +114,7 @@ class Main:
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         
         try:
-            checkpoint = torch.load("/models/best_model.pth", map_location=self.device)
+            checkpoint = torch.load(CHECKPOINT_PATH, map_location=self.device)
             print(f"Checkpoint keys: {list(checkpoint.keys())}")
             print(f"Model classes: {checkpoint['classes']}")
             
@@ -82,71 +149,200 @@ class Main:
                 if result.unexpected_keys:
                     print(f"Unexpected keys: {result.unexpected_keys}")
             
-            self.model.to(self.device)
             self.model.eval()
+            # BatchNorm is a fixed affine at eval time, fold it into the convs
+            self.model.fuse_for_inference()
+            self.model.to(self.device)
+
+            # FP16 + NHWC hits the cuDNN tensor core convolution kernels on the A10G
+            self.dtype = torch.float32
+            if self.device.type == "cuda":
+                self.dtype = torch.float16
+                self.model = self.model.half().to(memory_format=torch.channels_last)
+
+            self.engine = None
+            self.context = None
+            if self.device.type == "cuda" and os.path.exists(ENGINE_PATH):
+                if os.path.getmtime(ENGINE_PATH) >= os.path.getmtime(CHECKPOINT_PATH):
+                    self.load_engine(ENGINE_PATH)
+                else:
+                    print(f"{ENGINE_PATH} is older than {CHECKPOINT_PATH}, rebuild it with build_engine.py")
+
+            # only the plain forward is compiled, the feature map path stays eager
+            self.fast_model = self.model
+            self.graph = None
+            if self.device.type == "cuda":
+                # CUDA graphs are captured by hand below, so inductor must not add its own
+                self.fast_model = torch.compile(self.model, fullgraph=True)
+                # the engine serves every fixed-shape input, a graph it would shadow is wasted startup time
+                if self.context is None:
+                    self.capture_graph()
+                    self.warmup_batched()
             
-            self.processor = AudioProcessor()
+            self.processor = AudioProcessor(self.device)
+            # decoding is CPU bound and releases the GIL inside libsndfile
+            self.decode_pool = ThreadPoolExecutor(max_workers=ENGINE_MAX_BATCH)
             print("Model loaded successfully")
             
         except Exception as e:
             print(f"Error loading model: {e}")
             raise
 
-    @modal.fastapi_endpoint(method="POST")
-    def evaluate(self,request:EvaluateRequest):
-        # here upload to s3 then download from there but for now simply pass the file in the netwrok request
+    def capture_graph(self):
+        # the fast path is always padded to NUM_FRAMES, so the whole backbone replays as a single graph launch
+        self.static_input = torch.zeros((1, 1, 128, NUM_FRAMES), dtype=self.dtype, device=self.device).to(memory_format=torch.channels_last)
+
+        # warmup on a side stream, as torch.cuda.graph requires
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream), torch.inference_mode():
+            for _ in range(3):
+                self.fast_model(self.static_input)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.inference_mode(), torch.cuda.graph(self.graph):
+            self.static_output = self.fast_model(self.static_input)
+        print("CUDA graph captured")
+
+    def warmup_batched(self):
+        # evaluate_batch sends N>1 through the compiled model under autocast; compile that variant here
+        # with a dynamic batch dim rather than recompiling inside the first live batch request
+        batch = torch.zeros((2, 1, 128, NUM_FRAMES), dtype=self.dtype, device=self.device).to(memory_format=torch.channels_last)
+        torch._dynamo.mark_dynamic(batch, 0, min=2, max=ENGINE_MAX_BATCH)
+        with torch.inference_mode(), torch.autocast(self.device.type, dtype=self.dtype):
+            self.fast_model(batch)
+        print("Batched compile warmed up")
+
+    def load_engine(self, path):
+        # any failure here falls back to the torch model instead of failing container startup;
+        # plans only deserialize on the TensorRT version (and CUDA libs) that built them
+        try:
+            import tensorrt as trt
+
+            logger = trt.Logger(trt.Logger.WARNING)
+            with open(path, "rb") as f:
+                engine = trt.Runtime(logger).deserialize_cuda_engine(f.read())
+            context = engine.create_execution_context() if engine is not None else None
+        except Exception as e:
+            print(f"Could not load TensorRT engine from {path}: {e}, falling back to the torch model")
+            return
+        if context is None:
+            print(f"TensorRT could not deserialize {path} or create an execution context, falling back to the torch model")
+            return
+        self.engine = engine
+        self.context = context
+        print(f"Loaded INT8 TensorRT engine from {path}")
+
+    def run_engine(self, spectrogram):
+        spectrogram = spectrogram.float().contiguous()
+        self.context.set_input_shape("spectrogram", tuple(spectrogram.shape))
+        output = torch.empty((spectrogram.size(0), len(self.classes)), dtype=torch.float32, device=self.device)
+        self.context.execute_v2([spectrogram.data_ptr(), output.data_ptr()])
+        return output
+
+    def predict(self, spectrogram):
+        # logits only; the feature map path needs the eager model
+        if self.context is not None:
+            return self.run_engine(spectrogram)
+        if self.graph is not None and spectrogram.shape == self.static_input.shape:
+            self.static_input.copy_(spectrogram)
+            self.graph.replay()
+            return self.static_output.clone()
+        return self.fast_model(spectrogram)
+
+    def prepare_waveform(self, audio_data, sample_rate):
+        waveform = self.processor.load_waveform(audio_data)
+        if sample_rate != 44100:
+            waveform = self.processor.resample(waveform,sample_rate)
+        return waveform
 
-        audio_bytes = base64.b64decode(request.audio_data)
-        audio_data, sample_rate = sf.read(io.BytesIO(audio_bytes), dtype="float32")
+    def fix_length(self, waveform):
+        # predict() runs on a static shape (engine profile / captured graph), so pad/truncate to the
+        # training clip length; the debug path stays eager and keeps the full-length spectrogram
+        clip = waveform[:CLIP_SAMPLES]
+        if len(clip) < CLIP_SAMPLES:
+            clip = torch.nn.functional.pad(clip, (0, CLIP_SAMPLES - len(clip)))
+        return clip
 
-        if audio_data.ndim >1:
-            audio_data = np.mean(audio_data,axis=1)
+    @modal.fastapi_endpoint(method="POST")
+    def evaluate(self,request:EvaluateRequest, debug: bool = False):
+        # here upload to s3 then download from there but for now simply pass the file in the netwrok request
 
-        if sample_rate != 44100:
-            audio_data = librosa.resample(audio_data,orig_sr=sample_rate,target_sr=44100)
+        audio_data, sample_rate = decode_audio(request.audio_data)
+        waveform = self.prepare_waveform(audio_data, sample_rate)
+        model_input = waveform if debug else self.fix_length(waveform)
 
-        spectrogram = self.processor.process_audio(audio_data)
-        spectrogram = spectrogram.to(self.device)
+        spectrogram = self.processor.process_audio(model_input)
+        spectrogram = spectrogram.to(self.device, dtype=self.dtype, memory_format=torch.channels_last)
 
-        with torch.no_grad():
-            output, feature_maps = self.model(spectrogram, return_feature_maps=True)
-            output = torch.nan_to_num(output)
+        with torch.inference_mode(), torch.autocast(self.device.type, dtype=self.dtype, enabled=self.device.type == "cuda"):
+            # feature maps keep every block's activations alive, only collect them when asked for with ?debug=1
+            if debug:
+                output, feature_maps = self.model(spectrogram, return_feature_maps=True)
+            else:
+                output = self.predict(spectrogram)
+                feature_maps = {}
+            # softmax in FP32, FP16 logits can overflow in exp
+            # silent frames need no nan_to_num: AmplitudeToDB clamps to amin=1e-10 before log10
+            output = output.float()
 
             probabilities = torch.softmax(output,dim=1) # dim = 0 is batch and dim = 1 is classes
 
             top3_probs, top3_indices = torch.topk(probabilities,k=3)
 
-            predictions = [{"class": self.classes[idx.item()], "confidence": prob.item()} for prob,idx in zip(top3_probs[0],top3_indices[0])]
+            # one transfer for all top-3 values instead of an .item() sync per element
+            probs_cpu, idx_cpu = top3_probs[0].tolist(), top3_indices[0].tolist()
+            predictions = [{"class": self.classes[idx], "confidence": prob} for prob,idx in zip(probs_cpu,idx_cpu)]
 
             visualizations = {}
             for name, tensor in feature_maps.items():
                 if tensor.dim() == 4: #batch_size,channels,height,width
                     aggregate_tensor = torch.mean(tensor,dim=1)
                     squeezed_tensor = aggregate_tensor.squeeze(0)
-                    numpy_array = squeezed_tensor.cpu().numpy()
-                    clean_array = np.nan_to_num(numpy_array)
+                    numpy_array = squeezed_tensor.float().cpu().numpy()
                     visualizations[name] = {
-                        "shape": list(clean_array.shape),
-                        "values": clean_array.tolist()
+                        "shape": list(numpy_array.shape),
+                        "values": numpy_array
                     }
             # batch_size,channels,height,width
-            spectogram_np = spectrogram.squeeze(0).squeeze(0).cpu().numpy()
-            clean_spectogram = np.nan_to_num(spectogram_np)
+            spectogram_np = spectrogram.squeeze(0).squeeze(0).float().cpu().numpy()
 
             max_samples = 8000
-            if len(audio_data) > max_samples:
-                step = len(audio_data) // max_samples
-                waveform_data = audio_data[::step]
-            else:
-                waveform_data = audio_data
-            return {"predictions":predictions, "visualization":visualizations, "input_spectogram":{
-                "shape": list(clean_spectogram.shape),
-                "values": clean_spectogram.tolist()
+            if len(waveform) > max_samples:
+                step = len(waveform) // max_samples
+                waveform = waveform[::step]
+            waveform_data = waveform.contiguous().cpu().numpy() # orjson only serializes contiguous arrays
+            # orjson writes the ndarrays directly instead of building nested python lists
+            content = orjson.dumps({"predictions":predictions, "visualization":visualizations, "input_spectogram":{
+                "shape": list(spectogram_np.shape),
+                "values": spectogram_np
             }, "waveform": {
-                "values": waveform_data.tolist(),
+                "values": waveform_data,
                 "sample_rate": sample_rate,
                 "duration": len(audio_data) / sample_rate
-            }}
+            }}, option=orjson.OPT_SERIALIZE_NUMPY)
+            return Response(content=content, media_type="application/json")
+
+    @modal.fastapi_endpoint(method="POST")
+    def evaluate_batch(self,batch:EvaluateBatchRequest):
+        # all clips go through one forward pass, predictions only (no visualizations)
+        decoded = list(self.decode_pool.map(decode_audio, [request.audio_data for request in batch]))
+
+        clips = torch.stack([self.fix_length(self.prepare_waveform(audio_data, sample_rate)) for audio_data, sample_rate in decoded])
+        spectrogram = self.processor.process_audio(clips)
+        spectrogram = spectrogram.to(self.device, dtype=self.dtype, memory_format=torch.channels_last)
+
+        with torch.inference_mode(), torch.autocast(self.device.type, dtype=self.dtype, enabled=self.device.type == "cuda"):
+            output = self.predict(spectrogram).float()
+            probabilities = torch.softmax(output,dim=1)
+            top3_probs, top3_indices = torch.topk(probabilities,k=3)
+
+            results = []
+            for probs, indices in zip(top3_probs.tolist(), top3_indices.tolist()):
+                predictions = [{"class": self.classes[idx], "confidence": prob} for prob,idx in zip(probs,indices)]
+                results.append({"predictions": predictions})
+            return Response(content=orjson.dumps(results), media_type="application/json")
 
 
 @app.local_entrypoint()
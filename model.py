@@ -1,4 +1,5 @@
 from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 import torch
 
 class ResidualBlock(nn.Module):
@@ -47,6 +48,20 @@ class AudioClassifier(nn.Module):
         self.avgpool = nn.AdaptiveAvgPool2d((1,1))
         self.dropout = nn.Dropout(0.5)
         self.fc = nn.Linear(512,num_classes)
+    def fuse_for_inference(self):
+        # fold every eval-mode BatchNorm into the conv before it, leaving an Identity in its place
+        self.layer1[0] = fuse_conv_bn_eval(self.layer1[0], self.layer1[1])
+        self.layer1[1] = nn.Identity()
+        for layer in (self.layer2, self.layer3, self.layer4, self.layer5):
+            for block in layer:
+                block.conv1 = fuse_conv_bn_eval(block.conv1, block.bn1)
+                block.bn1 = nn.Identity()
+                block.conv2 = fuse_conv_bn_eval(block.conv2, block.bn2)
+                block.bn2 = nn.Identity()
+                if block.use_shortcut:
+                    block.shortcut[0] = fuse_conv_bn_eval(block.shortcut[0], block.shortcut[1])
+                    block.shortcut[1] = nn.Identity()
+        return self
     def forward(self,x, return_feature_maps=False):
         if not return_feature_maps:
             x = self.layer1(x)
@@ -0,0 +1,42 @@
+import modal
+import torch
+from torch.utils.data import DataLoader
+from pathlib import Path
+from tqdm import tqdm
+from train import ESC50Dataset, MEL_CACHE_PATH, make_mel_transform
+
+app = modal.App("Audio-Classification-Precompute-Mels")
+
+image = modal.Image.debian_slim().pip_install_from_requirements("requirements.txt").apt_install("libsndfile1").add_local_python_source("model", "train")
+
+volume = modal.Volume.from_name("ESC-50", create_if_missing=True)
+model_volume = modal.Volume.from_name("model-volume", create_if_missing=True)
+
+
+@app.function(image=image, gpu="A10G", volumes={"/opt/ESC-50": volume, "/models": model_volume}, timeout=60*30)
+def precompute_mels():
+    esc50_dir = Path("/opt/ESC-50")
+    if not (esc50_dir / "audio").exists():
+        raise RuntimeError("ESC-50 data not found in volume, run train.py once to download it")
+    dataset = ESC50Dataset(data_dir=esc50_dir, metadata_file=esc50_dir/"meta"/"esc50.csv", split="all")
+    loader = DataLoader(dataset, batch_size=64, shuffle=False, num_workers=8, pin_memory=True)
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # the STFT runs in FP32 (the power spectrum overflows FP16), only the dB output is stored as FP16
+    mel_transform = make_mel_transform().to(device)
+
+    batches = []
+    with torch.no_grad():
+        for waveforms, _ in tqdm(loader, desc="Computing mels"):
+            batches.append(mel_transform(waveforms.to(device, non_blocking=True)).half().cpu())
+    mels = torch.cat(batches) # (2000, 1, 128, 431)
+
+    torch.save({"mels": mels, "filenames": dataset.metadata["filename"].tolist()}, MEL_CACHE_PATH)
+    model_volume.commit()
+    print(f"Saved {tuple(mels.shape)} mel tensor to {MEL_CACHE_PATH}")
+    return 0
+
+
+@app.local_entrypoint()
+def main():
+    print("precomputing mels", precompute_mels.remote())
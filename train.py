@@ -5,7 +5,7 @@ from torch.optim.lr_scheduler import OneCycleLR
 from torch.utils.data import Dataset, DataLoader
 from pathlib import Path
 import pandas as pd
-import torchaudio
+import soundfile as sf
 import torch.nn as nn
 import torchaudio.transforms as T
 from tqdm import tqdm
@@ -15,20 +15,45 @@ from torch.utils.tensorboard import SummaryWriter
 
 app = modal.App("Audio CNN classifier")
 
+MEL_CACHE_PATH = "/models/esc50_mels.pt" # written by precompute_mels.py
+
+def make_mel_transform():
+    # shared by training, INT8 calibration and the mel cache, so they all see identical features
+    return nn.Sequential(
+        T.MelSpectrogram(
+            sample_rate=44100,
+            n_fft=2048,
+            hop_length=512,
+            n_mels=128,
+            f_min=0,
+            f_max=22050
+        ),
+        T.AmplitudeToDB()
+    )
+
 class ESC50Dataset(Dataset):
-    def __init__(self, data_dir, metadata_file, split="train", transform=None):
+    def __init__(self, data_dir, metadata_file, split="train", transform=None, num_samples=44100 * 5, mel_cache=None):
         self.data_dir = Path(data_dir)
         self.metadata = pd.read_csv(metadata_file)
         self.split = split
         self.transform = transform
+        self.num_samples = num_samples # every ESC-50 clip is 5s at 44.1kHz
 
         if(split == "train"):
             self.metadata = self.metadata[self.metadata["fold"] != 5]
         elif(split == "val"):
             self.metadata = self.metadata[self.metadata["fold"] == 5]
-        else:
+        elif(split != "all"):
             raise ValueError(f"Invalid split: {split}")
 
+        # precomputed FP16 mels are memory-mapped, items become slices instead of decode + FFT
+        self.mels = None
+        if(mel_cache is not None):
+            cache = torch.load(mel_cache, map_location="cpu", mmap=True)
+            self.mels = cache["mels"]
+            cache_index = {filename: i for i, filename in enumerate(cache["filenames"])}
+            self.mel_index = [cache_index[filename] for filename in self.metadata["filename"]]
+
         self.classes = sorted(self.metadata["category"].unique())
         self.class_to_idx = {cls: idx for idx, cls in enumerate(self.classes)}
         self.metadata["label"] = self.metadata["category"].map(self.class_to_idx)
@@ -38,11 +63,19 @@ class ESC50Dataset(Dataset):
 
     def __getitem__(self, idx):
         row = self.metadata.iloc[idx]
-        audio_path = self.data_dir / "audio" / row["filename"]
-        waveform, sample_rate = torchaudio.load(audio_path)
+        if(self.mels is not None):
+            return self.mels[self.mel_index[idx]], row["label"]
 
-        if(waveform.shape[0] > 1):
-            waveform = torch.mean(waveform, dim=0, keepdim=True)
+        audio_path = self.data_dir / "audio" / row["filename"]
+        # decode straight into a fixed-size buffer, shorter clips stay zero padded
+        waveform = torch.zeros(1, self.num_samples)
+        with sf.SoundFile(audio_path) as f:
+            frames = min(f.frames, self.num_samples)
+            if(f.channels == 1):
+                f.read(frames, dtype="float32", always_2d=True, out=waveform.numpy()[0, :frames, None])
+            else:
+                audio = f.read(frames, dtype="float32", always_2d=True)
+                waveform[0, :frames] = torch.from_numpy(audio.mean(axis=1))
         
         if(self.transform):
             spectogram = self.transform(waveform)
@@ -106,41 +139,37 @@ def train():
     else:
         print("ESC-50 data already exists in volume.")
 
+    if Path(MEL_CACHE_PATH).exists():
+        # mels were precomputed, batches are slices of the memory-mapped cache and a single H2D copy
+        print(f"Using precomputed mel spectrograms from {MEL_CACHE_PATH}")
+        mel_cache = MEL_CACHE_PATH
+        mel_transform = nn.Identity()
+        loader_kwargs = {"num_workers": 0, "pin_memory": True}
+    else:
+        # workers only decode raw waveforms, the mel transforms run batched on the GPU in the training step
+        mel_cache = None
+        mel_transform = make_mel_transform()
+        loader_kwargs = {"num_workers": 8, "pin_memory": True, "persistent_workers": True, "prefetch_factor": 4}
+
     train_transform = nn.Sequential(
-        T.MelSpectrogram(
-            sample_rate=44100,
-            n_fft=2048,
-            hop_length=512,
-            n_mels=128,
-            f_min=0,
-            f_max=22050
-        ),
-        T.AmplitudeToDB(),
-        T.FrequencyMasking(freq_mask_param=30),
-        T.TimeMasking(time_mask_param=80)
-    )
-    val_transform = nn.Sequential(
-        T.MelSpectrogram(
-            sample_rate=44100,
-            n_fft=2048,
-            hop_length=512,
-            n_mels=128,
-            f_min=0,
-            f_max=22050
-        ),
-        T.AmplitudeToDB()
+        mel_transform,
+        T.FrequencyMasking(freq_mask_param=30, iid_masks=True),
+        T.TimeMasking(time_mask_param=80, iid_masks=True)
     )
+    val_transform = mel_transform
 
-    train_dataset = ESC50Dataset(data_dir=esc50_dir,metadata_file=esc50_dir/"meta"/"esc50.csv",split="train",transform=train_transform)
-    val_dataset = ESC50Dataset(data_dir=esc50_dir,metadata_file=esc50_dir/"meta"/"esc50.csv",split="val",transform=val_transform)
+    train_dataset = ESC50Dataset(data_dir=esc50_dir,metadata_file=esc50_dir/"meta"/"esc50.csv",split="train",mel_cache=mel_cache)
+    val_dataset = ESC50Dataset(data_dir=esc50_dir,metadata_file=esc50_dir/"meta"/"esc50.csv",split="val",mel_cache=mel_cache)
 
     print(f"Train dataset size: {len(train_dataset)}")
     print(f"Validation dataset size: {len(val_dataset)}")
 
-    train_loader = DataLoader(train_dataset,batch_size=32,shuffle=True)
-    val_loader = DataLoader(val_dataset,batch_size=32,shuffle=False)
+    train_loader = DataLoader(train_dataset,batch_size=32,shuffle=True,**loader_kwargs)
+    val_loader = DataLoader(val_dataset,batch_size=32,shuffle=False,**loader_kwargs)
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    train_transform.to(device)
+    val_transform.to(device)
 
     model = AudioClassifier(num_classes=len(train_dataset.classes))
     model.to(device)
@@ -165,7 +194,8 @@ def train():
 
         progress_bar = tqdm(train_loader,desc=f"Epoch {epoch+1}/{num_epochs}")
         for data,target in progress_bar:
-            data,target = data.to(device),target.to(device) #spectograms and labels
+            data,target = data.to(device,non_blocking=True).float(),target.to(device,non_blocking=True) #waveforms or cached FP16 mels, and labels
+            data = train_transform(data) #spectograms
             if np.random.random() > 0.7:
                 data,target_a,target_b,mixup_lam,_ = mixup_audios(data,target)
                 output = model(data)
@@ -195,7 +225,8 @@ def train():
 
         with torch.no_grad():
             for data,target in val_loader:
-                data,target = data.to(device),target.to(device)
+                data,target = data.to(device,non_blocking=True).float(),target.to(device,non_blocking=True)
+                data = val_transform(data)
                 output = model(data)
                 loss = criterion(output,target)
                 val_loss += loss.item()
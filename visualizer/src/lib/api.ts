@@ -48,7 +48,8 @@ export class AudioAnalysisAPI {
       // Use Modal endpoint if available, otherwise use placeholder endpoint
       const endpoint = MODAL_ENDPOINT ?? '/api/evaluate';
       
-      const response = await fetch(endpoint, {
+      // debug=1 asks the server for the per-layer feature maps shown in the visualizer
+      const response = await fetch(`${endpoint}?debug=1`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',